@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: iso-8859-15 -*-
+"""End-to-end throughput benchmark of db_solver.py and db_watcher.py
+against a throwaway local PostgreSQL with synthetic solvers.
+
+Usage: python db_benchmark.py [--problems N] [--hosts N] [--cost-mean S]
+         [--cost-distribution constant|exponential|lognormal|bimodal]
+         [--mode watcher|notify|claim|cost-model ...]
+         [--sweep CONSTANT=value,value,... ...] [--output output.json]
+
+Every combination of the --sweep values is written into a
+db_defaults_local.py for each run, so any constant in db_defaults.py
+can be swept.
+
+"""
+# Copyright (C) 2018-2026, Andrew Kroshko, all rights reserved.
+#
+# Author: Andrew Kroshko
+# Maintainer: Andrew Kroshko <boreal6502@gmail.com>
+# Created: Sun Oct 18, 2026
+# Version: 20261018
+# URL: https://github.com/akroshko/python-sample-code
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+import argparse
+import datetime
+import glob
+import itertools
+import json
+import math as m
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+HERE=os.path.dirname(os.path.abspath(__file__))
+BATCH_TABLE='db_benchmark_batch'
+PROBLEM_TABLE='db_benchmark_problems'
+# extra command line arguments for (db_watcher.py,db_solver.py), None
+# if db_watcher.py is not run
+MODES={'watcher':([],[]),
+       'notify':(['--notify'],['--notify']),
+       'claim':(None,['--claim']),
+       'cost-model':(['--cost-model'],[])}
+
+# the solver objects db_solver.py imports, cost is in seconds
+SOLVER_MODULE='''
+import time
+
+class SyntheticResult(dict):
+    def has_key(self,k):
+        return k in self
+
+class SyntheticSolver(object):
+    def __init__(self,method_default_properties,ode_default_properties,incoming_properties,prepared=None):
+        self.spin=method_default_properties['spin']
+        self.cost=incoming_properties['cost']
+    def run(self,globals_dict):
+        if self.spin:
+            # keep a core busy, like a real solve
+            end=time.time()+self.cost
+            while time.time() < end:
+                pass
+        else:
+            time.sleep(self.cost)
+        return SyntheticResult(result=2.0*self.cost)
+
+synthetic_ode={}
+'''
+
+def start_postgres(directory,port):
+    """initdb and start a PostgreSQL that only listens on a socket in
+directory and logs every statement so they can be counted.
+
+    Returns the environment that points libpq at it.
+
+    """
+    datadirectory=os.path.join(directory,'data')
+    subprocess.check_call(['initdb','-D',datadirectory,'-A','trust','-U','postgres'],stdout=subprocess.DEVNULL)
+    options="-p %s -k %s -c listen_addresses='' -c log_statement=all -c fsync=off" % (port,directory)
+    subprocess.check_call(['pg_ctl','-D',datadirectory,'-l',os.path.join(directory,'postgres.log'),'-o',options,'-w','start'],stdout=subprocess.DEVNULL)
+    environment={'PGHOST':directory,'PGPORT':str(port),'PGUSER':'postgres','PGDATABASE':'postgres'}
+    return environment
+
+def stop_postgres(directory):
+    subprocess.call(['pg_ctl','-D',os.path.join(directory,'data'),'-m','immediate','stop'],stdout=subprocess.DEVNULL)
+
+def connect(environment):
+    return psycopg2.connect(host=environment['PGHOST'],port=environment['PGPORT'],
+                            user=environment['PGUSER'],dbname=environment['PGDATABASE'])
+
+def draw_costs(distribution,mean,count,rng):
+    """Seconds for each problem, all with the given mean."""
+    if distribution == 'constant':
+        return [mean]*count
+    elif distribution == 'exponential':
+        return [rng.expovariate(1.0/mean) for i in range(count)]
+    elif distribution == 'lognormal':
+        sigma=1.0
+        return [rng.lognormvariate(m.log(mean)-sigma**2/2,sigma) for i in range(count)]
+    elif distribution == 'bimodal':
+        # one in ten is ten times as long as the rest
+        short=mean/1.9
+        return [(10*short if rng.random() < 0.1 else short) for i in range(count)]
+    raise ValueError("unknown cost distribution: " + distribution)
+
+def create_tables(environment,costs,methods):
+    """Create the batch and problem tables with a problem for each cost,
+the problems are spread over methods distinct method_properties."""
+    CONNECTION=connect(environment)
+    CURSOR=CONNECTION.cursor()
+    CURSOR.execute("DROP TABLE IF EXISTS " + BATCH_TABLE + ";")
+    CURSOR.execute("DROP TABLE IF EXISTS " + PROBLEM_TABLE + ";")
+    CURSOR.execute("CREATE TABLE " + BATCH_TABLE + " (table_name text, solve_number bigint PRIMARY KEY, hostname text, done boolean NOT NULL DEFAULT FALSE);")
+    CURSOR.execute("CREATE TABLE " + PROBLEM_TABLE + " (solve_number bigint PRIMARY KEY, solver_object text, method_properties text, ode_properties text,"
+                   + " incoming_properties_keys text[], outgoing_properties_keys text[], cost double precision, result double precision, \"worker time\" double precision);")
+    CURSOR.execute("INSERT INTO " + PROBLEM_TABLE + " SELECT n,'<<SyntheticSolver>>','<<synthetic_method' || (n %% %s) || '>>','<<synthetic_ode>>',ARRAY['cost'],ARRAY['result'],cost"
+                   + " FROM unnest(%s::double precision[]) WITH ORDINALITY AS c(cost,n);",(methods,costs))
+    CURSOR.execute("INSERT INTO " + BATCH_TABLE + " (table_name,solve_number) SELECT %s,solve_number FROM " + PROBLEM_TABLE + ";",(PROBLEM_TABLE,))
+    CONNECTION.commit()
+    CONNECTION.close()
+
+def check_tables(environment):
+    """Returns the problems not done and the ones without a result."""
+    CONNECTION=connect(environment)
+    CURSOR=CONNECTION.cursor()
+    CURSOR.execute("SELECT count(*) FROM " + BATCH_TABLE + " WHERE done=FALSE;")
+    undone=CURSOR.fetchone()[0]
+    CURSOR.execute("SELECT count(*) FROM " + PROBLEM_TABLE + " WHERE result IS NULL;")
+    unsolved=CURSOR.fetchone()[0]
+    CONNECTION.close()
+    return undone,unsolved
+
+def write_run_directory(directory,constants,hosts,methods,spin):
+    """The directory db_solver.py and db_watcher.py add to sys.path, with
+the solver module and a db_defaults_local.py holding the constants of
+this run."""
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    with open(os.path.join(directory,'db_benchmark_solvers.py'),'w') as fh:
+        fh.write(SOLVER_MODULE)
+        for method in range(methods):
+            fh.write("synthetic_method%s={'spin':%r}\n" % (method,spin))
+    with open(os.path.join(directory,'db_defaults_local.py'),'w') as fh:
+        fh.write("HOSTLIST=%r\n" % hosts)
+        for name in sorted(constants):
+            fh.write("%s=%r\n" % (name,constants[name]))
+
+def statement_count(directory):
+    """Statements logged by the PostgreSQL in directory so far."""
+    with open(os.path.join(directory,'postgres.log'),errors='replace') as fh:
+        return sum(1 for line in fh if 'statement: ' in line)
+
+def percentile(values,fraction):
+    if values == []:
+        return None
+    values=sorted(values)
+    return values[min(len(values)-1,int(fraction*len(values)))]
+
+def run_once(arguments,pgdirectory,environment,mode,constants,costs):
+    """Run db_watcher.py and a db_solver.py for each host until all the
+problems are solved, and summarize the metrics the solvers log."""
+    rundirectory=os.path.join(pgdirectory,'run')
+    hosts=['db-benchmark-host%s' % i for i in range(arguments.hosts)]
+    write_run_directory(rundirectory,constants,hosts,arguments.methods,arguments.spin)
+    create_tables(environment,costs,arguments.methods)
+    watcher_arguments,solver_arguments=MODES[mode]
+    statements=statement_count(pgdirectory)
+    # the indexes are created once here rather than by each db_solver.py
+    subprocess.run(arguments.python.split() + [os.path.join(HERE,'db_watcher.py'),rundirectory,'db_benchmark_solvers',BATCH_TABLE,'--setup'],
+                   env=dict(os.environ,**environment),cwd=HERE,stdout=subprocess.DEVNULL,check=True)
+    starttime=time.time()
+    processes=[]
+    for host in hosts:
+        hostenvironment=dict(os.environ,**environment)
+        hostenvironment['PYMATHDBHOSTNAME']=host
+        hostenvironment['PYMATHDBTMP']=os.path.join(rundirectory,host)
+        os.makedirs(hostenvironment['PYMATHDBTMP'])
+        processes.append(subprocess.Popen(arguments.python.split() + [os.path.join(HERE,'db_solver.py'),rundirectory,'db_benchmark_solvers',BATCH_TABLE] + solver_arguments,
+                                          env=hostenvironment,cwd=HERE,stdout=subprocess.DEVNULL))
+    if watcher_arguments is not None:
+        watcher=subprocess.Popen(arguments.python.split() + [os.path.join(HERE,'db_watcher.py'),rundirectory,'db_benchmark_solvers',BATCH_TABLE] + watcher_arguments,
+                                 env=dict(os.environ,**environment),cwd=HERE,stdout=subprocess.DEVNULL)
+        processes.append(watcher)
+    for process in processes:
+        remaining=starttime+arguments.timeout-time.time()
+        try:
+            process.wait(timeout=max(remaining,1))
+        except subprocess.TimeoutExpired:
+            for p in processes:
+                p.kill()
+            break
+    elapsed=time.time()-starttime
+    statements=statement_count(pgdirectory)-statements
+    undone,unsolved=check_tables(environment)
+    # what the solvers logged about themselves
+    records=[]
+    for filename in glob.glob(os.path.join(rundirectory,'*','db_solver_capture_output','*','metrics.jsonl')):
+        with open(filename) as fh:
+            records.extend(json.loads(line) for line in fh)
+    commit_seconds=[r['commit seconds'] for r in records if r['kind'] == 'write']
+    # idle time at the end, from when each host received its last result
+    last_result=dict((host,starttime) for host in hosts)
+    for r in records:
+        if r['kind'] == 'task':
+            last_result[r['host']]=max(last_result[r['host']],r['time'])
+    endtime=max(last_result.values())
+    tail_idle=[endtime-t for t in last_result.values()]
+    solved=len(costs)-unsolved
+    # the processes each db_solver.py says it runs
+    processes=sum(r['processes'] for r in records if r['kind'] == 'start')
+    return {'mode':mode,
+            'constants':constants,
+            'problems':len(costs),
+            'solved':solved,
+            'undone':undone,
+            'seconds':elapsed,
+            'problems_per_second':solved/elapsed,
+            'processes':processes,
+            'ideal_problems_per_second':(len(costs)/(sum(costs)/processes) if processes else None),
+            'statements':statements,
+            'statements_per_problem':(statements/solved if solved else None),
+            'commits':len(commit_seconds),
+            'commit_seconds_mean':(sum(commit_seconds)/len(commit_seconds) if commit_seconds else None),
+            'commit_seconds_p95':percentile(commit_seconds,0.95),
+            'tail_idle_seconds_max':max(tail_idle),
+            'tail_idle_seconds_mean':sum(tail_idle)/len(tail_idle)}
+
+def sweep_constants(sweeps):
+    """Every combination of the values of the --sweep arguments."""
+    names=[]
+    values=[]
+    for sweep in sweeps:
+        name,sweep_values=sweep.split('=',1)
+        names.append(name)
+        # numbers where possible, so the constants keep their types
+        values.append([json.loads(v) if v.replace('.','',1).replace('-','',1).isdigit() else v for v in sweep_values.split(',')])
+    return [dict(zip(names,combination)) for combination in itertools.product(*values)]
+
+def main(argv):
+    parser=argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--problems',type=int,default=2000)
+    parser.add_argument('--hosts',type=int,default=2)
+    parser.add_argument('--methods',type=int,default=4,help='distinct method_properties')
+    parser.add_argument('--cost-mean',type=float,default=0.005,help='mean seconds per problem')
+    parser.add_argument('--cost-distribution',default='exponential')
+    parser.add_argument('--spin',action='store_true',help='busy wait rather than sleep in the solver')
+    parser.add_argument('--mode',action='append',choices=sorted(MODES),help='can be given more than once')
+    parser.add_argument('--sweep',action='append',default=[],help='CONSTANT=value,value,...')
+    parser.add_argument('--repeat',type=int,default=1)
+    parser.add_argument('--timeout',type=float,default=600)
+    parser.add_argument('--port',type=int,default=55432)
+    parser.add_argument('--python',default='sage -python',help='runs db_solver.py and db_watcher.py')
+    parser.add_argument('--output',default='db_benchmark_' + datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + '.json')
+    arguments=parser.parse_args(argv[1:])
+    modes=arguments.mode or ['watcher']
+    costs=draw_costs(arguments.cost_distribution,arguments.cost_mean,arguments.problems,random.Random(20261018))
+    pgdirectory=tempfile.mkdtemp(prefix='db_benchmark_')
+    results=[]
+    try:
+        environment=start_postgres(pgdirectory,arguments.port)
+        for mode in modes:
+            for constants in sweep_constants(arguments.sweep):
+                for repeat in range(arguments.repeat):
+                    result=run_once(arguments,pgdirectory,environment,mode,constants,costs)
+                    results.append(result)
+                    print("%-10s %-40s %8.1f problems/s %6.1f statements/problem %s tail idle %s" %
+                          (mode,json.dumps(constants,sort_keys=True),result['problems_per_second'],result['statements_per_problem'] or 0,
+                           ('%.3fs' % result['tail_idle_seconds_max']),
+                           ('' if result['undone'] == 0 else '(%s not done)' % result['undone'])))
+                    sys.stdout.flush()
+    finally:
+        stop_postgres(pgdirectory)
+        shutil.rmtree(pgdirectory)
+    with open(arguments.output,'w') as fh:
+        json.dump({'python':sys.version,
+                   'timestamp':datetime.datetime.now().isoformat(),
+                   'problems':arguments.problems,
+                   'hosts':arguments.hosts,
+                   'cost_distribution':arguments.cost_distribution,
+                   'cost_mean':arguments.cost_mean,
+                   'results':results},fh,indent=1)
+    print("Written to: %s" % arguments.output)
+
+if __name__ == '__main__':
+    main(sys.argv)
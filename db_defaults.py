@@ -24,7 +24,7 @@
 
 # configuration options
 
-__all__= ['MAXUPDATESTRINGS','LIMITPERSEGMENT','CHECKDELAY','HOSTLIST','MAXREDUCTIONS','TYPICAL_CORES','NOMINAL_PARITIONS','WORKWAIT']
+__all__= ['MAXUPDATESTRINGS','LIMITPERSEGMENT','CHECKDELAY','HOSTLIST','MAXREDUCTIONS','TYPICAL_CORES','NOMINAL_PARITIONS','WORKWAIT','CLAIM_SECONDS','CLAIM_INITIAL','CLAIM_LEASE','HEARTBEAT','TASKCHUNK','WRITEDELAY','PREPARED_CACHE_SIZE','VECTORBATCH','COST_KEYS','COST_REFRESH','CHUNK_SECONDS','HOST_CAPACITY','PROFILE_FRACTION','METRICS_TABLE']
 # tuning parameters to reduce load on database
 
 MAXUPDATESTRINGS=4096
@@ -48,3 +48,37 @@ NOMINAL_PARITIONS=16
 # make hostname specific
 # LIMITPERSEGMENT=2048
 WORKWAIT=2
+# with db_solver.py --claim, size each claim to last about this many
+# seconds at the rate the host finished its previous claim
+CLAIM_SECONDS=60
+# the first claim, before anything is known about the host
+CLAIM_INITIAL=64
+# claimed problems that are not done are taken over by other hosts if
+# the host that claimed them has not renewed its claim for this many
+# seconds, a running db_solver.py renews several times per lease
+CLAIM_LEASE=300
+# with --notify, check the database this often even if nothing has
+# been notified, in case a notification is missed
+HEARTBEAT=30
+# most problems sent to a worker process at once
+TASKCHUNK=64
+# most problems sent at once to a solver with run_batch
+VECTORBATCH=1024
+# write results if none have arrived for this many seconds
+WRITEDELAY=5
+# solvers with their method and ODE setup kept by each worker process
+PREPARED_CACHE_SIZE=32
+# with db_watcher.py --cost-model, problems with the same solver,
+# method, ODE and these incoming properties are expected to take the
+# same time
+COST_KEYS=[]
+# predict again from the newly solved problems this often
+COST_REFRESH=60
+# predicted seconds of work assigned per core at once
+CHUNK_SECONDS=300
+# cores for each host in HOSTLIST, TYPICAL_CORES if not given
+HOST_CAPACITY={}
+# with db_solver.py --profile, the fraction of solves that are profiled
+PROFILE_FRACTION=0.01
+# with db_solver.py --metrics-table, the table the metrics also go into
+METRICS_TABLE='db_solver_metrics'
@@ -0,0 +1,70 @@
+#!/usr/local/bin/sage -python
+# -*- coding: iso-8859-15 -*-
+"""PostgreSQL LISTEN/NOTIFY used by db_solver.py and db_watcher.py to
+wake each other up rather than polling the database."""
+# Copyright (C) 2018-2026, Andrew Kroshko, all rights reserved.
+#
+# Author: Andrew Kroshko
+# Maintainer: Andrew Kroshko <boreal6502@gmail.com>
+# Created: Sun Oct 18, 2026
+# Version: 20261018
+# URL: https://github.com/akroshko/python-sample-code
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+import select
+import time
+
+__all__= ['assigned_channel','done_channel','db_listen','db_notify','db_wait']
+
+# XXXX: notifications are only delivered between transactions, so
+#       always commit before db_wait and commit after db_notify
+
+def assigned_channel(batch_table):
+    """The channel db_watcher.py notifies with the hostname that was just
+assigned work."""
+    return batch_table + '_assigned'
+
+def done_channel(batch_table):
+    """The channel db_solver.py notifies with its hostname after
+committing results."""
+    return batch_table + '_done'
+
+def db_listen(CONNECTION,CURSOR,channel):
+    CURSOR.execute('LISTEN "' + channel + '";')
+    CONNECTION.commit()
+
+def db_notify(CURSOR,channel,payload):
+    """Notify channel, this is sent when the current transaction commits."""
+    CURSOR.execute("SELECT pg_notify(%s,%s);",(channel,payload))
+
+def db_wait(CONNECTION,timeout,payload=None):
+    """Block on the connection until a notification arrives, or one with
+payload if given, or until timeout seconds pass as a heartbeat.
+
+    Returns the payloads received.
+
+    """
+    deadline=time.time()+timeout
+    payloads=[]
+    while True:
+        CONNECTION.poll()
+        while CONNECTION.notifies:
+            payloads.append(CONNECTION.notifies.pop(0).payload)
+        if payloads != [] and (payload is None or payload in payloads):
+            return payloads
+        remaining=deadline-time.time()
+        if remaining <= 0:
+            return payloads
+        select.select([CONNECTION],[],[],remaining)
@@ -0,0 +1,142 @@
+#!/usr/local/bin/sage -python
+# -*- coding: iso-8859-15 -*-
+"""The state of the batch table that db_solver.py and db_watcher.py
+schedule work from, counted in the database rather than by fetching
+rows."""
+# Copyright (C) 2018-2026, Andrew Kroshko, all rights reserved.
+#
+# Author: Andrew Kroshko
+# Maintainer: Andrew Kroshko <boreal6502@gmail.com>
+# Created: Sun Oct 18, 2026
+# Version: 20261018
+# URL: https://github.com/akroshko/python-sample-code
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+__all__= ['FAILED_SUFFIX','db_index_names','db_create_indexes','db_indexes_exist','db_create_lease_column','db_lease_exists','db_work_counts','db_work_exists','db_assign_chunk','db_mark_failed','db_claim_chunk','db_renew_claims','db_release_claims']
+
+# the hostname of a problem that failed on a host is the host with this
+# added, so it is not counted as that host's work or assigned again
+FAILED_SUFFIX=':failed'
+
+def db_index_names(batch_table):
+    """The names of the partial indexes on batch_table."""
+    index_prefix='db_' + batch_table.replace('.','_')
+    return [index_prefix + '_pending',index_prefix + '_unassigned']
+
+def db_create_indexes(CONNECTION,CURSOR,batch_table):
+    """Create the partial indexes the scheduling queries use if they do
+not exist, these only cover work that is not done so they stay small
+as a run goes on.
+
+    This should only be run from one place, db_watcher.py or
+    db_watcher.py --setup.  If another connection creates the same index
+    at the same time that is not an error.
+
+    """
+    pending_index,unassigned_index=db_index_names(batch_table)
+    for create_string in ["CREATE INDEX IF NOT EXISTS " + pending_index + " ON " + batch_table + " (hostname) WHERE done=FALSE;",
+                          "CREATE INDEX IF NOT EXISTS " + unassigned_index + " ON " + batch_table + " (solve_number) WHERE hostname IS NULL AND done=FALSE;"]:
+        try:
+            CURSOR.execute(create_string)
+            CONNECTION.commit()
+        except Exception as e:
+            # XXXX: IF NOT EXISTS does not stop two sessions creating
+            #       the same index at once, the loser gets a
+            #       unique_violation on pg_class or a duplicate_table
+            if getattr(e,'pgcode',None) not in ('23505','42P07'):
+                raise
+            CONNECTION.rollback()
+
+def db_indexes_exist(CURSOR,batch_table):
+    """Returns whether the partial indexes on batch_table exist, without
+taking any locks on it."""
+    # unquoted names are folded to lower case and cut to 63 characters
+    index_names=[index_name.lower()[:63] for index_name in db_index_names(batch_table)]
+    CURSOR.execute("SELECT count(*) FROM pg_indexes WHERE indexname = ANY(%s);",(index_names,))
+    return CURSOR.fetchone()[0] == len(index_names)
+
+def db_create_lease_column(CONNECTION,CURSOR,batch_table):
+    """Add the claimed column db_solver.py --claim keeps its lease on
+its problems in, also only run from db_watcher.py."""
+    CURSOR.execute("ALTER TABLE " + batch_table + " ADD COLUMN IF NOT EXISTS claimed timestamptz;")
+    CONNECTION.commit()
+
+def db_lease_exists(CURSOR,batch_table):
+    """Returns whether batch_table has the claimed column."""
+    CURSOR.execute("SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid=%s::regclass AND attname='claimed' AND NOT attisdropped);",(batch_table,))
+    return CURSOR.fetchone()[0]
+
+def db_work_counts(CURSOR,batch_table):
+    """Returns {hostname:problems not done} for every host, with None
+for the unassigned problems."""
+    CURSOR.execute("SELECT hostname,count(*) FROM " + batch_table + " WHERE done=FALSE GROUP BY hostname;")
+    return dict(CURSOR.fetchall())
+
+def db_work_exists(CURSOR,batch_table,host,excluded=()):
+    """Returns whether host has work that is not done and whether there
+is unassigned work, the solve_numbers in excluded are not counted."""
+    CURSOR.execute("SELECT EXISTS (SELECT 1 FROM " + batch_table + " WHERE hostname=%s AND done=FALSE AND solve_number <> ALL(%s)),"
+                   + "EXISTS (SELECT 1 FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE);",(host,list(excluded)))
+    return CURSOR.fetchone()
+
+def db_assign_chunk(CURSOR,batch_table,host,number_to_assign):
+    """Assign up to number_to_assign unassigned problems to host in the
+database, rows another connection is assigning at the same time are
+skipped rather than waited for.
+
+    Returns the number assigned.
+
+    """
+    CURSOR.execute("UPDATE " + batch_table + " SET hostname=%s WHERE ctid IN (SELECT ctid FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE LIMIT %s FOR UPDATE SKIP LOCKED);",(host,number_to_assign))
+    return CURSOR.rowcount
+
+def db_mark_failed(CURSOR,batch_table,host,solve_numbers):
+    """Mark problems whose solver raised on host as failed, they stay
+not done.  Setting their hostname back to NULL runs them again."""
+    CURSOR.execute("UPDATE " + batch_table + " SET hostname=%s WHERE solve_number = ANY(%s) AND done=FALSE;",(host + FAILED_SUFFIX,list(solve_numbers)))
+    return CURSOR.rowcount
+
+def db_claim_chunk(CURSOR,batch_table,host,number_to_claim,lease):
+    """Claim up to number_to_claim problems for host with a lease that
+starts now, like db_assign_chunk.  Unassigned problems are claimed
+first, if there are none then problems whose lease another host has
+not renewed for lease seconds are taken over.
+
+    Returns the number claimed.
+
+    """
+    CURSOR.execute("UPDATE " + batch_table + " SET hostname=%s,claimed=now() WHERE ctid IN (SELECT ctid FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE LIMIT %s FOR UPDATE SKIP LOCKED);",(host,number_to_claim))
+    if CURSOR.rowcount > 0:
+        return CURSOR.rowcount
+    # problems assigned by db_watcher.py have no lease and are never
+    # taken over
+    CURSOR.execute("UPDATE " + batch_table + " SET hostname=%s,claimed=now() WHERE ctid IN (SELECT ctid FROM " + batch_table + " WHERE hostname <> %s AND hostname NOT LIKE %s AND done=FALSE AND claimed < now() - %s * interval '1 second' LIMIT %s FOR UPDATE SKIP LOCKED);",(host,host,'%' + FAILED_SUFFIX,lease,number_to_claim))
+    return CURSOR.rowcount
+
+def db_renew_claims(CURSOR,batch_table,host):
+    """Renew the lease on every problem host has claimed that is not
+done."""
+    CURSOR.execute("UPDATE " + batch_table + " SET claimed=now() WHERE hostname=%s AND done=FALSE AND claimed IS NOT NULL;",(host,))
+    return CURSOR.rowcount
+
+def db_release_claims(CURSOR,batch_table,host):
+    """Put every problem host has claimed that is not done back as
+unassigned.
+
+    Returns the number released.
+
+    """
+    CURSOR.execute("UPDATE " + batch_table + " SET hostname=NULL,claimed=NULL WHERE hostname=%s AND done=FALSE AND claimed IS NOT NULL;",(host,))
+    return CURSOR.rowcount
@@ -34,12 +34,29 @@ pymath_default_imports(globals(),locals())
 exec('from ' + sys.argv[2] + ' import *')
 
 import Queue
+import cProfile
+import collections
+import decimal
+import json
+import numbers
+import random
+import threading
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    TEXT_TYPE=unicode
+except NameError:
+    TEXT_TYPE=str
 
 from db_defaults import *
 try:
     from db_defaults_local import *
 except ImportError:
     pass
+from db_notify import *
+from db_schedule import *
 
 # XXXX: the PYMATHDBTMP environment variable must be set to a
 #       temporary path this can be on a different device to meet
@@ -54,8 +71,21 @@ else:
     # XXXX: change this to match the cores per CPU
     PROCESSES=4
 MAXTASKSPERCHILD=512
+# each db_solver claims its own work from the batch table, db_watcher.py
+# and HOSTLIST are not needed, hosts can start or stop at any time
+CLAIM_WORK='--claim' in sys.argv
+# wait for db_watcher.py to notify that work was assigned rather than
+# polling, db_watcher.py must also be run with --notify
+NOTIFY_WORK='--notify' in sys.argv
+# profile PROFILE_FRACTION of the solves into SPECIFIC_LOGDIR
+PROFILE_WORKERS='--profile' in sys.argv
+# the timing and counters written to SPECIFIC_LOGDIR/metrics.jsonl
+# also go into METRICS_TABLE
+METRICS_TO_TABLE='--metrics-table' in sys.argv
 
-THEHOSTNAME=socket.gethostname()
+# XXXX: the PYMATHDBHOSTNAME environment variable can be set to run
+#       several db_solver.py as different hosts on one machine
+THEHOSTNAME=os.getenv('PYMATHDBHOSTNAME') or socket.gethostname()
 
 # XXXX: set this extremely large, if there are wierd problems, delete
 #       this line
@@ -79,27 +109,28 @@ if __name__ == '__main__':
         # TODO: add a help message and exit
         sys.exit(1)
 
-def db_solver_worker(q,solve_number,selected_solver,incoming_properties_dict,redirect_stdout_path=None):
-    """A worker that runs the solver with a particular set of
-parameters.
+# each worker process keeps the solver_object, method_properties,
+# ode_properties and anything the solver prepares from them, keyed by
+# their placeholders, least recently used is dropped first
+PREPARED_CACHE=collections.OrderedDict()
+PREPARED_CACHE_STATS={'hits':0,'misses':0}
+
+def prepared_solver(selected_solver):
+    """Looks up (solver_object,method_properties,ode_properties,prepared)
+in PREPARED_CACHE for the placeholders in selected_solver.
+
+    A solver_object with a prepare(method_default_properties,
+    ode_default_properties) method does its setup there, and whatever
+    it returns is passed to the solver_object as prepared.  Anything
+    else is constructed the same way as always.
 
     """
-    # DBSOLVERTIMESTAMP should clear out as soon as things are reset
-    # TODO: do not check verbose flag every time
-    worker_time=TIME_TIME()
-    verbose_flag='--verbose' in sys.argv
-    if redirect_stdout_path:
-        stdout_old=sys.stdout
-        if verbose_flag:
-            # I like to remove buffering during verbose so i can catch
-            # the last possible output if something locks up this is
-            # especially useful when viewing over SSH
-            fh=open(os.path.join(redirect_stdout_path,str(os.getpid())+'.out'),"a", buffering=0)
-        else:
-            # do not put anything to stdout during production runs
-            fh=open(os.devnull,"a")
-        sys.stdout = fh
-    try:
+    key=tuple(selected_solver[0][:3])
+    if key in PREPARED_CACHE:
+        PREPARED_CACHE_STATS['hits']+=1
+        prepared=PREPARED_CACHE.pop(key)
+    else:
+        PREPARED_CACHE_STATS['misses']+=1
         # placeholders in strings that reference solver objects are
         # surrounded by '<<' '>>'
         if not selected_solver[0][0].startswith('<<') or not selected_solver[0][0].endswith('>>'):
@@ -111,6 +142,39 @@ parameters.
         solver_object              = globals()[selected_solver[0][0].strip('<>')]
         method_properties          = globals()[selected_solver[0][1].strip('<>')]
         ode_properties             = globals()[selected_solver[0][2].strip('<>')]
+        if hasattr(solver_object,'prepare'):
+            prepared=solver_object.prepare(method_default_properties=method_properties,
+                                           ode_default_properties=ode_properties)
+        else:
+            prepared=None
+        prepared=(solver_object,method_properties,ode_properties,prepared)
+        if len(PREPARED_CACHE) >= PREPARED_CACHE_SIZE:
+            PREPARED_CACHE.popitem(last=False)
+    PREPARED_CACHE[key]=prepared
+    return prepared
+
+# a generator for each worker process, a forked copy of the same one
+# would sample the same solves in every process
+PROFILE_RANDOM={}
+
+def profile_sampled():
+    if os.getpid() not in PROFILE_RANDOM:
+        PROFILE_RANDOM[os.getpid()]=random.Random()
+    return PROFILE_RANDOM[os.getpid()].random() < PROFILE_FRACTION
+
+def db_solver_worker(selected_solver,incoming_properties_dict,verbose_flag=False):
+    """A worker that runs the solver with a particular set of
+parameters.
+
+    Returns outgoing_properties_dict, or None if the solver raised an
+    exception.
+
+    """
+    # DBSOLVERTIMESTAMP should clear out as soon as things are reset
+    worker_time=TIME_TIME()
+    outgoing_properties_dict=None
+    try:
+        solver_object,method_properties,ode_properties,prepared = prepared_solver(selected_solver)
         incoming_properties_keys   = selected_solver[0][3]
         outgoing_properties_keys   = selected_solver[0][4]
         if verbose_flag:
@@ -118,9 +182,23 @@ parameters.
             pprint(ode_properties)
             pprint(method_properties)
             pprint(incoming_properties_dict)
-        outgoing_properties = solver_object(method_default_properties=method_properties,
-                                            ode_default_properties=ode_properties,
-                                            incoming_properties=incoming_properties_dict).run(globals())
+        def solve():
+            if prepared is None:
+                return solver_object(method_default_properties=method_properties,
+                                     ode_default_properties=ode_properties,
+                                     incoming_properties=incoming_properties_dict).run(globals())
+            else:
+                return solver_object(method_default_properties=method_properties,
+                                     ode_default_properties=ode_properties,
+                                     incoming_properties=incoming_properties_dict,
+                                     prepared=prepared).run(globals())
+        if PROFILE_WORKERS and profile_sampled():
+            profile=cProfile.Profile()
+            outgoing_properties = profile.runcall(solve)
+            # view with pstats or snakeviz
+            profile.dump_stats(os.path.join(SPECIFIC_LOGDIR,'profile_' + str(os.getpid()) + '_' + ('%.6f' % TIME_TIME()) + '.prof'))
+        else:
+            outgoing_properties = solve()
         new_dict={}
         for k in outgoing_properties_keys:
             if outgoing_properties.has_key(k):
@@ -131,10 +209,7 @@ parameters.
         # TODO: add more error checking to make sure nothing invalid goes into the queue
         if verbose_flag:
             pprint(outgoing_properties_dict)
-        # put outgoing_properties_dict into the queue, block until there is space
-        # TODO: wish I was not blocking here, or I at least knew the amount of time spent blocking
         outgoing_properties_dict['worker time']=TIME_TIME()-worker_time
-        q.put((solve_number,outgoing_properties_dict),block=True)
     except Exception as e:
         # print out all relevant information if an exception occurs
         # TODO: option to send exception data to stderr and/or log
@@ -142,54 +217,515 @@ parameters.
         print(str(e))
         # TODO: make sure this goes to stderr
         traceback.print_exc()
-    if redirect_stdout_path:
+    return outgoing_properties_dict
+
+def db_solver_run_batch(selected_solver,incoming_properties_dicts,verbose_flag=False):
+    """Runs a batch with the run_batch classmethod of solver_object, which
+gets the incoming properties as one list per key and returns one
+sequence per outgoing key.  Each problem is given an equal share of the
+time as its worker time.
+
+    Returns the outgoing columns, or None if the solver raised an
+    exception.
+
+    """
+    worker_time=TIME_TIME()
+    try:
+        solver_object,method_properties,ode_properties,prepared = prepared_solver(selected_solver)
+        incoming_properties_keys   = selected_solver[0][3]
+        outgoing_properties_keys   = selected_solver[0][4]
+        incoming_columns=dict((k,[d[k] for d in incoming_properties_dicts]) for k in incoming_properties_keys)
         if verbose_flag:
-            sys.stdout.flush()
-        sys.stdout.close()
-        sys.stdout=stdout_old
+            print("--------------------")
+            pprint(ode_properties)
+            pprint(method_properties)
+            pprint(incoming_columns)
+        if prepared is None:
+            outgoing_properties = solver_object.run_batch(method_default_properties=method_properties,
+                                                          ode_default_properties=ode_properties,
+                                                          incoming_properties=incoming_columns,
+                                                          globals_dict=globals())
+        else:
+            outgoing_properties = solver_object.run_batch(method_default_properties=method_properties,
+                                                          ode_default_properties=ode_properties,
+                                                          incoming_properties=incoming_columns,
+                                                          globals_dict=globals(),
+                                                          prepared=prepared)
+        outgoing_columns={}
+        for k in outgoing_properties_keys:
+            if outgoing_properties.has_key(k):
+                # plain values so they can be pickled and written
+                outgoing_columns[k]=list(outgoing_properties[k])
+                if len(outgoing_columns[k]) != len(incoming_properties_dicts):
+                    raise RuntimeError("run_batch returned the wrong number of " + k + "!!!")
+            else:
+                outgoing_columns[k]=[None]*len(incoming_properties_dicts)
+        if verbose_flag:
+            pprint(outgoing_columns)
+        outgoing_columns['worker time']=[(TIME_TIME()-worker_time)/len(incoming_properties_dicts)]*len(incoming_properties_dicts)
+        return outgoing_columns
+    except Exception as e:
+        print(str(e))
+        traceback.print_exc()
+        return None
+
+def db_solver_batch(selected_solver,solve_numbers,incoming_properties_dicts,redirect_stdout_path=None):
+    """Runs a batch of problems that share selected_solver as one task, so
+cheap problems do not each make a round trip to the pool.
+
+    Solvers with a run_batch classmethod solve the whole batch in one
+    call, if that raises or the solver does not have one the problems
+    are run one at a time.
+
+    Returns (solve_numbers,outgoing columns,failed solve_numbers,
+    finished time,worker stats), with the columns in the same order as
+    solve_numbers.
+
+    """
+    # TODO: do not check verbose flag every time
+    verbose_flag='--verbose' in sys.argv
+    stdout_old=sys.stdout
+    solve_time=TIME_TIME()
+    vectorized=False
+    try:
+        if redirect_stdout_path:
+            if verbose_flag:
+                # I like to remove buffering during verbose so i can catch
+                # the last possible output if something locks up this is
+                # especially useful when viewing over SSH
+                fh=open(os.path.join(redirect_stdout_path,str(os.getpid())+'.out'),"a", buffering=0)
+            else:
+                # do not put anything to stdout during production runs
+                fh=open(os.devnull,"a")
+            sys.stdout = fh
+        outgoing_columns=None
+        failed=[]
+        solver_name=selected_solver[0][0].strip('<>')
+        if len(solve_numbers) > 1 and hasattr(globals().get(solver_name),'run_batch'):
+            outgoing_columns=db_solver_run_batch(selected_solver,incoming_properties_dicts,verbose_flag)
+        vectorized=outgoing_columns is not None
+        if outgoing_columns is None:
+            outgoing_columns=dict((k,[]) for k in list(selected_solver[0][4])+['worker time'])
+            solved=[]
+            for solve_number,incoming_properties_dict in zip(solve_numbers,incoming_properties_dicts):
+                outgoing_properties_dict=db_solver_worker(selected_solver,incoming_properties_dict,verbose_flag)
+                if outgoing_properties_dict is None:
+                    failed.append(solve_number)
+                else:
+                    solved.append(solve_number)
+                    for k in outgoing_columns:
+                        outgoing_columns[k].append(outgoing_properties_dict[k])
+            solve_numbers=solved
+    except Exception:
+        # anything outside the try of each problem, like the .out file
+        # not opening, every problem must still come back to the writer
+        # or it is outstanding forever
+        traceback.print_exc()
+        failed=list(solve_numbers)
+        solve_numbers=[]
+        outgoing_columns={}
+    finally:
+        if sys.stdout is not stdout_old:
+            if verbose_flag:
+                sys.stdout.flush()
+            sys.stdout.close()
+            sys.stdout=stdout_old
+    worker_stats={'pid':os.getpid(),
+                  'solve seconds':TIME_TIME()-solve_time,
+                  'vectorized':vectorized,
+                  'cache hits':PREPARED_CACHE_STATS['hits'],
+                  'cache misses':PREPARED_CACHE_STATS['misses']}
+    # the time it takes this to get back to the main process is measured from here
+    return (solve_numbers,outgoing_columns,failed,TIME_TIME(),worker_stats)
 
-def db_more_work(batch_table,CURSOR):
-    """Checks the database for more work to be done."""
+def db_more_work(batch_table,CONNECTION,CURSOR):
+    """Checks the database for more work to be done, problems that
+failed here do not count."""
+    with OUTSTANDING_CONDITION:
+        failed=list(FAILED)
     if PROCESSES == 1:
         # ignore all hostname designations if only one process
-        selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=FALSE;"
-        CURSOR.execute(selected_batch_string)
-        selected=CURSOR.fetchall()
-    else:
-        # is there work for this hostname
-        selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + THEHOSTNAME + "' AND done=FALSE;"
-        CURSOR.execute(selected_batch_string)
-        selected=CURSOR.fetchall()
-        if selected == []:
-            # check if there is unassigned work
-            selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE;"
-            CURSOR.execute(selected_unassigned_string)
-            unassigned=CURSOR.fetchall()
-            if unassigned != []:
-                # TODO: I'd like to get this into one select that does
-                #       everything keep waiting for 5-10s at a time
-                #       until some work is assigned or no more work is
-                #       available
-                while selected == [] and unassigned != []:
-                    time.sleep(WORKWAIT)
-                    # TODO: selected unassigned and hostname stuff
-                    #       together distinguish here rather than doing 2
-                    #       selects
-                    CURSOR.execute(selected_batch_string)
-                    selected=CURSOR.fetchall()
-                    if selected == []:
-                        CURSOR.execute(selected_unassigned_string)
-                        unassigned=CURSOR.fetchall()
-                    else:
-                        unassigned == None
-                if selected == [] and unassigned == []:
-                    return False
+        CURSOR.execute("SELECT EXISTS (SELECT 1 FROM " + batch_table + " WHERE done=FALSE AND solve_number <> ALL(%s));",(failed,))
+        return CURSOR.fetchone()[0]
+    # is there work for this hostname, or unassigned work it may get
+    host_work,unassigned_work=db_work_exists(CURSOR,batch_table,THEHOSTNAME,failed)
+    # keep waiting until some work is assigned or no more work is
+    # available
+    while not host_work and unassigned_work:
+        if NOTIFY_WORK:
+            CONNECTION.commit()
+            db_wait(CONNECTION,HEARTBEAT,THEHOSTNAME)
+        else:
+            time.sleep(WORKWAIT)
+        host_work,unassigned_work=db_work_exists(CURSOR,batch_table,THEHOSTNAME,failed)
+    # no work for this host and no unassigned work means this
+    # db_solver is done
+    return host_work
+
+# the size of the next claim and the size and time of the last one
+CLAIM_STATE={'size':CLAIM_INITIAL,'claimed':0,'time':None}
+
+def db_claim_work(batch_table,CONNECTION,CURSOR,outstanding):
+    """Claims a chunk of unassigned work for this host once everything
+already claimed has been started.  Concurrent claims by other hosts skip
+each other's locked rows rather than waiting or claiming the same rows.
+
+    Returns True if there is claimed work that is not done and has not
+    failed.
+
+    """
+    with OUTSTANDING_CONDITION:
+        failed=list(FAILED)
+    # problems that failed here are never started again so do not count
+    CURSOR.execute("SELECT count(*) FROM " + batch_table + " WHERE hostname=%s AND done=FALSE AND solve_number <> ALL(%s);",(THEHOSTNAME,failed))
+    pending=CURSOR.fetchone()[0]
+    if pending - len(outstanding) >= PROCESSES:
+        CONNECTION.commit()
+        return True
+    now=TIME_TIME()
+    if CLAIM_STATE['time'] is not None and now > CLAIM_STATE['time']:
+        # the last claim has about drained, size this one to take
+        # CLAIM_SECONDS at the same rate
+        rate=CLAIM_STATE['claimed']/(now-CLAIM_STATE['time'])
+        CLAIM_STATE['size']=int(min(max(rate*CLAIM_SECONDS,PROCESSES),LIMITPERSEGMENT))
+    # rows claimed by a host that died are taken over once its lease
+    # runs out
+    claimed=db_claim_chunk(CURSOR,batch_table,THEHOSTNAME,CLAIM_STATE['size'],CLAIM_LEASE)
+    CONNECTION.commit()
+    CLAIM_STATE['claimed']=claimed
+    CLAIM_STATE['time']=now
+    if claimed > 0:
+        print("==== " + THEHOSTNAME + ": Claimed " + str(claimed) + " ====")
+        sys.stdout.flush()
+    return (pending + claimed) > 0
+
+# solve_number and the quoted columns selected for each distinct
+# incoming_properties_keys
+INCOMING_COLUMNS_CACHE={}
+
+def db_fetch_work(selected,CURSOR):
+    """Fetch the solver and the incoming properties for a segment of
+(dbtable,solve_number) rows, with a few queries per dbtable rather than
+two per problem.
+
+    Returns the dbtable for each solve_number and the
+    (selected_solver,incoming_properties_dict) for each solve_number
+    that db_solver_worker takes.
+
+    """
+    dbtable_dict={}
+    solve_numbers_by_table={}
+    for dbtable,solve_number in selected:
+        dbtable_dict[solve_number]=dbtable
+        solve_numbers_by_table.setdefault(dbtable,[]).append(solve_number)
+    selected_solver_dict={}
+    for dbtable,solve_numbers in solve_numbers_by_table.items():
+        selectstring = "SELECT solve_number,solver_object,method_properties,ode_properties,incoming_properties_keys,outgoing_properties_keys FROM " + dbtable + " WHERE solve_number = ANY(%s);"
+        CURSOR.execute(selectstring,(solve_numbers,))
+        # problems that share incoming_properties_keys are selected together
+        selected_solvers_by_keys={}
+        for selected_row in CURSOR.fetchall():
+            incoming_properties_keys=tuple(selected_row[4])
+            selected_solvers_by_keys.setdefault(incoming_properties_keys,{})[selected_row[0]]=[selected_row[1:]]
+        for incoming_properties_keys,selected_solvers in selected_solvers_by_keys.items():
+            if incoming_properties_keys not in INCOMING_COLUMNS_CACHE:
+                # solve_number and the columns, a problem can have no
+                # incoming properties
+                INCOMING_COLUMNS_CACHE[incoming_properties_keys]=','.join(['solve_number'] + ['"' + k + '"' for k in incoming_properties_keys])
+            selecting_incoming_string="SELECT " + INCOMING_COLUMNS_CACHE[incoming_properties_keys] + " FROM " + dbtable + " WHERE solve_number = ANY(%s);"
+            CURSOR.execute(selecting_incoming_string,(list(selected_solvers.keys()),))
+            for incoming_row in CURSOR.fetchall():
+                incoming_properties_dict=dict(zip(incoming_properties_keys,incoming_row[1:]))
+                selected_solver_dict[incoming_row[0]]=(selected_solvers[incoming_row[0]],incoming_properties_dict)
+    return dbtable_dict,selected_solver_dict
+
+def copy_text(value):
+    """Format a value as the text PostgreSQL reads it from.  Anything
+that is not a number, boolean, string, date or time, sequence or dict
+raises a TypeError rather than being written as whatever str() gives.
+
+    """
+    if hasattr(value,'tolist'):
+        # NumPy arrays and scalars, numpy.bool_ is not a bool and str()
+        # of an array is not an array literal
+        value=value.tolist()
+    if isinstance(value,bool):
+        return 't' if value else 'f'
+    elif isinstance(value,numbers.Integral):
+        return str(int(value))
+    elif isinstance(value,numbers.Real):
+        value=float(value)
+        if value != value:
+            return 'NaN'
+        elif value == float('inf'):
+            return 'Infinity'
+        elif value == float('-inf'):
+            return '-Infinity'
+        return repr(value)
+    elif isinstance(value,decimal.Decimal):
+        return str(value)
+    elif isinstance(value,str):
+        return value
+    elif isinstance(value,TEXT_TYPE):
+        # XXXX: only reached with Python 2, the COPY buffer is a byte
+        #       string there
+        return value.encode('utf-8')
+    elif isinstance(value,(list,tuple)):
+        # array literal, every element is quoted
+        elements=[]
+        for element in value:
+            if hasattr(element,'tolist'):
+                element=element.tolist()
+            if element is None:
+                elements.append('NULL')
+            elif isinstance(element,(list,tuple)):
+                elements.append(copy_text(element))
+            else:
+                elements.append('"' + copy_text(element).replace('\\','\\\\').replace('"','\\"') + '"')
+        return '{' + ','.join(elements) + '}'
+    elif isinstance(value,dict):
+        return json.dumps(value)
+    elif hasattr(value,'isoformat'):
+        # datetime, date and time
+        return value.isoformat()
+    raise TypeError("can not write " + type(value).__name__ + " " + repr(value)[:80] + " to the database!!!")
+
+def copy_escape(value):
+    """Format a value for COPY ... FROM STDIN in text format."""
+    if value is None:
+        return '\\N'
+    return copy_text(value).replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r')
+
+def db_write_results(update_results,batch_table,CONNECTION,CURSOR):
+    """Write results back with COPY into a temporary table and a single
+UPDATE ... FROM per dbtable, then mark the whole batch done and commit.
+
+    update_results is {dbtable:[(solve_numbers,outgoing columns),...]}
+    where the outgoing columns are {key:[value for each solve_number]}
+
+    Returns the seconds taken to update and to commit.
+
+    """
+    update_time=TIME_TIME()
+    print("Updating...")
+    sys.stdout.flush()
+    solve_numbers=[]
+    for dbtable,blocks in update_results.items():
+        # blocks with the same keys go through the same temporary table
+        blocks_by_keys={}
+        for block_solve_numbers,outgoing_columns in blocks:
+            blocks_by_keys.setdefault(tuple(sorted(outgoing_columns.keys())),[]).append((block_solve_numbers,outgoing_columns))
+            solve_numbers.extend(block_solve_numbers)
+        for outgoing_properties_keys,keyed_blocks in blocks_by_keys.items():
+            quoted_keys=['"' + k + '"' for k in outgoing_properties_keys]
+            CURSOR.execute("DROP TABLE IF EXISTS db_solver_results;")
+            # only the column types, none of the constraints
+            CURSOR.execute("CREATE TEMPORARY TABLE db_solver_results AS SELECT solve_number," + ','.join(quoted_keys) + " FROM " + dbtable + " WITH NO DATA;")
+            copy_buffer=StringIO()
+            for block_solve_numbers,outgoing_columns in keyed_blocks:
+                columns=[outgoing_columns[k] for k in outgoing_properties_keys]
+                for i,solve_number in enumerate(block_solve_numbers):
+                    copy_buffer.write('\t'.join([copy_escape(solve_number)] + [copy_escape(column[i]) for column in columns]) + '\n')
+            copy_buffer.seek(0)
+            CURSOR.copy_expert("COPY db_solver_results (solve_number," + ','.join(quoted_keys) + ") FROM STDIN;",copy_buffer)
+            CURSOR.execute("UPDATE " + dbtable + " SET " + ', '.join([k + '=db_solver_results.' + k for k in quoted_keys]) + " FROM db_solver_results WHERE " + dbtable + ".solve_number=db_solver_results.solve_number;")
+            CURSOR.execute("DROP TABLE db_solver_results;")
+    # update the work table
+    CURSOR.execute("UPDATE " + batch_table + " SET done=TRUE WHERE solve_number = ANY(%s);",(solve_numbers,))
+    if NOTIFY_WORK:
+        db_notify(CURSOR,done_channel(batch_table),THEHOSTNAME)
+    print("Committing...")
+    sys.stdout.flush()
+    commit_time=TIME_TIME()
+    CONNECTION.commit()
+    print("Done committing.")
+    sys.stdout.flush()
+    return commit_time-update_time,TIME_TIME()-commit_time
+
+class RoundTripCursor(object):
+    """A cursor that counts the statements it sends to the database."""
+    def __init__(self,cursor):
+        self.cursor=cursor
+        self.round_trips=0
+    def execute(self,*args):
+        self.round_trips+=1
+        return self.cursor.execute(*args)
+    def copy_expert(self,*args):
+        self.round_trips+=1
+        return self.cursor.copy_expert(*args)
+    def __getattr__(self,name):
+        return getattr(self.cursor,name)
+
+# the open SPECIFIC_LOGDIR/metrics.jsonl and records waiting to go into
+# METRICS_TABLE
+METRICS={'fh':None,'records':[]}
+METRICS_LOCK=threading.Lock()
+
+def log_metrics(kind,record):
+    """Write one record of timing and counters as a line of JSON, both
+the main loop and the writer thread log."""
+    record['kind']=kind
+    record['host']=THEHOSTNAME
+    record['time']=TIME_TIME()
+    line=json.dumps(record,sort_keys=True)
+    with METRICS_LOCK:
+        if METRICS['fh'] is not None:
+            METRICS['fh'].write(line + '\n')
+            METRICS['fh'].flush()
+        if METRICS_TO_TABLE:
+            METRICS['records'].append(line)
+
+def db_create_metrics_table(CONNECTION,CURSOR):
+    CURSOR.execute("CREATE TABLE IF NOT EXISTS " + METRICS_TABLE + " (batch_table text, record jsonb);")
+    CONNECTION.commit()
+
+def db_write_metrics(batch_table,CONNECTION,CURSOR):
+    """Insert the records logged since the last call into METRICS_TABLE."""
+    with METRICS_LOCK:
+        records=METRICS['records']
+        METRICS['records']=[]
+    if records != []:
+        CURSOR.execute("INSERT INTO " + METRICS_TABLE + " (batch_table,record) SELECT %s,r::jsonb FROM unnest(%s::text[]) r;",(batch_table,records))
+        CONNECTION.commit()
+
+# results of db_solver_batch are handed from the pool to the writer
+# thread through here
+RESULTS_QUEUE=Queue.Queue()
+# dbtable for each solve_number that is submitted and not yet committed
+OUTSTANDING={}
+# solve_numbers whose solver raised an exception, these are not
+# submitted again
+FAILED=set()
+# tasks given to the pool whose results have not reached the writer,
+# each is a batch of up to TASKCHUNK or VECTORBATCH problems
+TASKS_IN_FLIGHT={'count':0}
+# guards OUTSTANDING, FAILED and TASKS_IN_FLIGHT, the main loop waits on
+# this for the tasks in flight to go down
+OUTSTANDING_CONDITION=threading.Condition()
+# seconds between a batch finishing and the writer getting it
+RESULT_WAIT={'count':0,'total':0.0,'max':0.0}
+# the latest worker stats of each worker process, for the cache counts
+WORKER_CACHE_STATS={}
+
+def db_collect_results(batch):
+    """Callback for db_solver_batch, runs in the pool's result thread so
+it does nothing that can block.
+
+    """
+    RESULTS_QUEUE.put((TIME_TIME(),batch))
+
+def db_writer(batch_table,in_flight_limit):
+    """The writer thread, batches results and writes them with its own
+connection while the pool keeps running.
+
+    Results are written when MAXUPDATESTRINGS is reached, when no more
+    than in_flight_limit tasks are still being solved, or when
+    nothing has arrived for WRITEDELAY seconds.  Anything left is
+    written once None is put on RESULTS_QUEUE.
+
+    """
+    CONNECTION,CURSOR=open_database(None,None)
+    CURSOR=RoundTripCursor(CURSOR)
+    # results waiting to be written, by dbtable
+    update_results={}
+    queued_updates=0
+    written=0
+    start_time=TIME_TIME()
+    renewed_time=start_time
+    finished=False
+    while not finished:
+        timed_out=False
+        try:
+            item=RESULTS_QUEUE.get(timeout=WRITEDELAY)
+            if item is None:
+                finished=True
             else:
-                # no unassigned work and no work for this host, return
-                # False because this db_solver is done
-                return False
-    # return True if we make it here and there is more work
-    return (selected != [])
+                received,(solve_numbers,outgoing_columns,failed,finished_time,worker_stats)=item
+                WORKER_CACHE_STATS[worker_stats['pid']]=worker_stats
+                worker_stats.update({'problems':len(solve_numbers)+len(failed),
+                                     'failed':len(failed),
+                                     'result wait seconds':received-finished_time})
+                log_metrics('task',worker_stats)
+                if failed != []:
+                    # so db_watcher.py and db_claim_work do not count
+                    # them as this host's work
+                    db_mark_failed(CURSOR,batch_table,THEHOSTNAME,failed)
+                    CONNECTION.commit()
+                RESULT_WAIT['count']+=1
+                RESULT_WAIT['total']+=received-finished_time
+                RESULT_WAIT['max']=max(RESULT_WAIT['max'],received-finished_time)
+                with OUTSTANDING_CONDITION:
+                    TASKS_IN_FLIGHT['count']-=1
+                    for solve_number in failed:
+                        del OUTSTANDING[solve_number]
+                        FAILED.add(solve_number)
+                    if solve_numbers != []:
+                        # a batch only has problems from one dbtable
+                        update_results.setdefault(OUTSTANDING[solve_numbers[0]],[]).append((solve_numbers,outgoing_columns))
+                        queued_updates+=len(solve_numbers)
+                    OUTSTANDING_CONDITION.notify_all()
+        except Queue.Empty:
+            timed_out=True
+        # still being solved
+        in_flight=len(OUTSTANDING)-queued_updates
+        # XXXX: each result used to be two update strings
+        if update_results != {} and (finished or timed_out or queued_updates*2 > MAXUPDATESTRINGS or TASKS_IN_FLIGHT['count'] <= in_flight_limit):
+            print(THEHOSTNAME, "Solve number list: %s" % in_flight)
+            # XXXX: spaces added for readability
+            print(THEHOSTNAME, "Queued for update:    %s" % queued_updates)
+            if RESULT_WAIT['count'] > 0:
+                print(THEHOSTNAME, "Result wait:      %.4fs mean %.4fs max" % (RESULT_WAIT['total']/RESULT_WAIT['count'],RESULT_WAIT['max']))
+            # XXXX: counts from workers that were replaced after
+            #       MAXTASKSPERCHILD are kept
+            print(THEHOSTNAME, "Prepared cache:   %s hits %s misses" % (sum(c['cache hits'] for c in WORKER_CACHE_STATS.values()),sum(c['cache misses'] for c in WORKER_CACHE_STATS.values())))
+            sys.stdout.flush()
+            round_trips=CURSOR.round_trips
+            update_seconds,commit_seconds=db_write_results(update_results,batch_table,CONNECTION,CURSOR)
+            written+=queued_updates
+            log_metrics('write',{'problems':queued_updates,
+                                 'update seconds':update_seconds,
+                                 'commit seconds':commit_seconds,
+                                 'round trips':CURSOR.round_trips-round_trips,
+                                 'in flight':in_flight,
+                                 'tasks in flight':TASKS_IN_FLIGHT['count'],
+                                 'queue depth':RESULTS_QUEUE.qsize(),
+                                 'problems per second':written/(TIME_TIME()-start_time)})
+            # only now can these be selected as not done without being solved again
+            with OUTSTANDING_CONDITION:
+                for blocks in update_results.values():
+                    for solve_numbers,outgoing_columns in blocks:
+                        for solve_number in solve_numbers:
+                            del OUTSTANDING[solve_number]
+                OUTSTANDING_CONDITION.notify_all()
+            update_results={}
+            queued_updates=0
+        if METRICS_TO_TABLE and (finished or timed_out or update_results == {}):
+            db_write_metrics(batch_table,CONNECTION,CURSOR)
+        if CLAIM_WORK and TIME_TIME()-renewed_time > CLAIM_LEASE/4.0:
+            # this runs at least every WRITEDELAY even if the main loop
+            # is waiting on long solves
+            db_renew_claims(CURSOR,batch_table,THEHOSTNAME)
+            CONNECTION.commit()
+            renewed_time=TIME_TIME()
+    CONNECTION.close()
+
+def db_release_host(batch_table):
+    """With --claim, put the problems this host claimed that are not done
+or failed back as unassigned, so the other hosts take them now rather than
+when the lease runs out.  Has its own connection since the one in main
+may be why db_solver.py is exiting.
+
+    """
+    try:
+        CONNECTION,CURSOR=open_database(None,None)
+        released=db_release_claims(CURSOR,batch_table,THEHOSTNAME)
+        CONNECTION.commit()
+        CONNECTION.close()
+        print("==== "  + THEHOSTNAME + ": Released " + str(released) + " ====")
+        sys.stdout.flush()
+    except Exception:
+        # they are still taken over once CLAIM_LEASE passes
+        traceback.print_exc()
 
 # XXXX: POOL must be defined before main() function but after the
 #       workers
@@ -205,142 +741,158 @@ def main(argv):
     global SPECIFIC_LOGDIR
     # connect to the database
     CONNECTION,CURSOR=open_database(None,None)
-    # create the Queue
-    m = multiprocessing.Manager()
-    q = m.Queue()
+    CURSOR=RoundTripCursor(CURSOR)
+    METRICS['fh']=open(os.path.join(SPECIFIC_LOGDIR,'metrics.jsonl'),'a')
+    if METRICS_TO_TABLE:
+        db_create_metrics_table(CONNECTION,CURSOR)
+    # how this host is set up, so throughput can be compared with what
+    # its processes could do
+    log_metrics('start',{'processes':PROCESSES,
+                         'claim':CLAIM_WORK,
+                         'notify':NOTIFY_WORK})
+    if NOTIFY_WORK:
+        db_listen(CONNECTION,CURSOR,assigned_channel(batch_table))
+    if CLAIM_WORK and not db_lease_exists(CURSOR,batch_table):
+        raise RuntimeError("no claimed column on " + batch_table + ", run db_watcher.py with --setup first!!!")
+    if CLAIM_WORK and not db_indexes_exist(CURSOR,batch_table):
+        # XXXX: creating them here races with every other db_solver.py
+        #       starting at the same time, so only warn
+        print("==== " + THEHOSTNAME + ": No scheduling indexes on " + batch_table + ", run db_watcher.py with --setup first ====")
+        sys.stdout.flush()
+    CONNECTION.commit()
+    if PROCESSES == 1:
+        redirect_stdout_path=None
+    else:
+        redirect_stdout_path=SPECIFIC_LOGDIR
+    # get more work once this few tasks are left, a task is a batch of
+    # problems so this still leaves one queued behind the one running
+    # on each process, serial runs finish everything first
+    if '--serial' in sys.argv:
+        in_flight_limit=0
+    else:
+        in_flight_limit=2*PROCESSES
+    writer=threading.Thread(target=db_writer,args=(batch_table,in_flight_limit))
+    writer.daemon=True
+    writer.start()
     # if only one process, ignore hostname find next batch of work,
     # this gets work if possible
-    solve_number_list=[]
     limitpersegement_str=str(LIMITPERSEGMENT)
-    while db_more_work(batch_table,CURSOR) or solve_number_list != []:
-        selected_solver_dict={}
-        if PROCESSES == 1:
-            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=FALSE LIMIT " + limitpersegement_str + ";"
+    while (db_claim_work(batch_table,CONNECTION,CURSOR,OUTSTANDING) if CLAIM_WORK else db_more_work(batch_table,CONNECTION,CURSOR)) or OUTSTANDING:
+        fetch_time=TIME_TIME()
+        round_trips=CURSOR.round_trips
+        # XXXX: the writer commits done=TRUE before it removes problems
+        #       from OUTSTANDING, so anything outstanding after this
+        #       snapshot is either excluded here or seen as done by
+        #       the SELECT below, filtering against OUTSTANDING after
+        #       the SELECT would submit problems committed in between
+        #       a second time
+        with OUTSTANDING_CONDITION:
+            failed=list(FAILED)
+            excluded=set(OUTSTANDING)
+        excluded.update(failed)
+        # problems that failed here are left as they are rather than
+        # selected again
+        if PROCESSES == 1 and not CLAIM_WORK:
+            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE done=FALSE AND solve_number <> ALL(%s) LIMIT " + limitpersegement_str + ";"
         else:
-            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + THEHOSTNAME + "' AND done=FALSE LIMIT " + limitpersegement_str + ";"
-        CURSOR.execute(selected_batch_string)
+            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + THEHOSTNAME + "' AND done=FALSE AND solve_number <> ALL(%s) LIMIT " + limitpersegement_str + ";"
+        CURSOR.execute(selected_batch_string,(failed,))
         selected=CURSOR.fetchall()
         CONNECTION.commit()
         # build the select strings first
         print("==== "  + THEHOSTNAME + ": Building select strings and incoming properties ====")
         sys.stdout.flush()
         ##########
-        dbtable_dict={}
         # XXXX: this section was one of the biggest bottlenecks for
-        #       large numbers of easy problems indexing by
-        #       solve_number solves this issue for now, otherwise, it
-        #       scales quadratically or much worse once the number of
-        #       problems climbed above 100000
-        selectstring_list=[]
-        for dbtable,solve_number in selected:
-            dbtable_dict[solve_number]=dbtable
-            # TODO: do these selects seperately
-            # TODO: trim selected_solver to ensure solve_number is not used
-            solve_number_str=str(solve_number)
-            selectstring = "SELECT solver_object,method_properties,ode_properties,incoming_properties_keys,outgoing_properties_keys FROM " + dbtable + " WHERE solve_number=" + solve_number_str + ';'
-            CURSOR.execute(selectstring)
-            selected_solver=CURSOR.fetchall()
-            # select the standard things
-            incoming_properties_keys   = selected_solver[0][3]
-            # select incoming
-            # TODO: try to only do this once....
-            incoming_properties_keys_quoted = ['"' + k + '"' for k in incoming_properties_keys]
-            selecting_incoming_string="SELECT " + ','.join(incoming_properties_keys_quoted) + " FROM " + dbtable +  " WHERE solve_number=" + solve_number_str + ";"
-            CURSOR.execute(selecting_incoming_string)
-            incoming_properties_values=CURSOR.fetchall()[0]
-            incoming_properties_dict=dict(zip(incoming_properties_keys,incoming_properties_values))
-            selected_solver_dict[solve_number]=(selected_solver,incoming_properties_dict)
+        #       large numbers of easy problems, indexing by
+        #       solve_number and fetching everything for a table at
+        #       once solves this issue for now
+        selected=[(dbtable,solve_number) for dbtable,solve_number in selected if solve_number not in excluded]
+        dbtable_dict,selected_solver_dict=db_fetch_work(selected,CURSOR)
         CONNECTION.commit()
         print("==== " + THEHOSTNAME + ": Starting solution ==========")
         sys.stdout.flush()
-        for solve_number in selected_solver_dict:
-            if solve_number in solve_number_list:
-                continue
-            if PROCESSES==1:
-                POOL.apply_async(db_solver_worker,(q,solve_number,selected_solver_dict[solve_number][0],selected_solver_dict[solve_number][1]))
+        dispatch_time=TIME_TIME()
+        # problems that share a dbtable and selected_solver are run
+        # together in batches, this also keeps a worker's
+        # PREPARED_CACHE in use since a pool cannot be told which
+        # worker gets a task
+        batches={}
+        with OUTSTANDING_CONDITION:
+            for solve_number in selected_solver_dict:
+                # must be outstanding before the result can possibly come back
+                OUTSTANDING[solve_number]=dbtable_dict[solve_number]
+                selected_solver,incoming_properties_dict=selected_solver_dict[solve_number]
+                key=(dbtable_dict[solve_number],)+tuple(selected_solver[0][:3])+(tuple(selected_solver[0][3]),tuple(selected_solver[0][4]))
+                if key not in batches:
+                    batches[key]=(selected_solver,[],[])
+                batches[key][1].append(solve_number)
+                batches[key][2].append(incoming_properties_dict)
+        for key in sorted(batches):
+            selected_solver,solve_numbers,incoming_properties_dicts=batches[key]
+            if hasattr(globals().get(selected_solver[0][0].strip('<>')),'run_batch'):
+                # as few batches as possible while using every process
+                batchsize=max(1,min(VECTORBATCH,-(-len(solve_numbers)//PROCESSES)))
             else:
-                #
-                POOL.apply_async(db_solver_worker,(q,solve_number,selected_solver_dict[solve_number][0],selected_solver_dict[solve_number][1],SPECIFIC_LOGDIR))
-            solve_number_list.append(solve_number)
+                # several cheap problems per task, but still about 4
+                # tasks per process so long problems are spread out
+                batchsize=max(1,min(TASKCHUNK,len(selected_solver_dict)//(PROCESSES*4)))
+            with OUTSTANDING_CONDITION:
+                TASKS_IN_FLIGHT['count']+=-(-len(solve_numbers)//batchsize)
+            for i in range(0,len(solve_numbers),batchsize):
+                POOL.apply_async(db_solver_batch,(selected_solver,solve_numbers[i:i+batchsize],incoming_properties_dicts[i:i+batchsize],redirect_stdout_path),callback=db_collect_results)
         ##########
+        wait_time=TIME_TIME()
         print("==== "  + THEHOSTNAME + ": Processing solutions ====")
-        # TODO: add some text to explain this
-        print(len(solve_number_list))
+        # number of problems submitted and not yet committed
+        print(len(OUTSTANDING))
+        sys.stdout.flush()
+        # the writer thread removes things from OUTSTANDING as they
+        # are committed, get more work once few enough tasks are left
+        with OUTSTANDING_CONDITION:
+            if selected_solver_dict == {}:
+                # nothing new was found, wait for the rest to finish but
+                # still look for new work every WRITEDELAY
+                deadline=TIME_TIME()+WRITEDELAY
+                while OUTSTANDING and TIME_TIME() < deadline:
+                    if not writer.is_alive():
+                        raise RuntimeError("writer thread stopped!!!")
+                    OUTSTANDING_CONDITION.wait(deadline-TIME_TIME())
+            else:
+                while TASKS_IN_FLIGHT['count'] > in_flight_limit:
+                    if not writer.is_alive():
+                        raise RuntimeError("writer thread stopped!!!")
+                    OUTSTANDING_CONDITION.wait(WRITEDELAY)
+        log_metrics('segment',{'selected':len(selected),
+                               'submitted':len(selected_solver_dict),
+                               'batches':len(batches),
+                               'fetch seconds':dispatch_time-fetch_time,
+                               'dispatch seconds':wait_time-dispatch_time,
+                               'wait seconds':TIME_TIME()-wait_time,
+                               'round trips':CURSOR.round_trips-round_trips,
+                               'outstanding':len(OUTSTANDING),
+                               'queue depth':RESULTS_QUEUE.qsize()})
+    RESULTS_QUEUE.put(None)
+    writer.join()
+    if FAILED:
+        # these stay not done, marked with FAILED_SUFFIX
+        print("==== "  + THEHOSTNAME + ": Failed problems left: %s ====" % len(FAILED))
         sys.stdout.flush()
-        update_strings=[]
-        # TODO: this is many statements pasted as one right now, could be made faster into fewer statements
-        # TODO: best way will be bulk update using temp table for each
-        #       dbtable from
-        while solve_number_list != []:
-            # XXXX: I think this should be good, this blocks, but won't run unless there are things left
-            # TODO: this blocks... hence the code above
-            try:
-                outgoing=q.get(timeout=5)
-                solve_number=outgoing[0]
-                outgoing_properties_dict=outgoing[1]
-                outgoing_properties_keys=outgoing_properties_dict.keys()
-                dbtable=dbtable_dict[solve_number]
-                solve_number_list.remove(solve_number)
-                #
-                # TODO: want to copy to table...
-                outgoing_properties_strings = ['\"' + k + '\"=%(' + k + ')s' for k in outgoing_properties_keys]
-                solve_number_str=str(solve_number)
-                outgoing_properties_update_string="UPDATE " + dbtable + " SET " + ', '.join(outgoing_properties_strings) + " WHERE solve_number=" + solve_number_str + ";"
-                outgoing_properties_update_string=CURSOR.mogrify(outgoing_properties_update_string,outgoing_properties_dict)
-                update_strings.append(outgoing_properties_update_string)
-                # update the work table
-                update_batch_table_string="UPDATE " + batch_table + " SET done=TRUE WHERE solve_number=" + solve_number_str + ";"
-                update_strings.append(update_batch_table_string)
-            except Queue.Empty:
-                print("Queue empty...")
-                sys.stdout.flush()
-                # if queue times out and processors are not all doing work, try and get more work
-                if len(solve_number_list) <= PROCESSES and '--serial' not in sys.argv:
-                    # this should not take too long... but maybe add
-                    # timeout...  update before breaking
-                    if update_strings != []:
-                        print("Updating...")
-                        sys.stdout.flush()
-                        CURSOR.execute(''.join(update_strings))
-                        print("Committing...")
-                        sys.stdout.flush()
-                        CONNECTION.commit()
-                        print("Done committing.")
-                        sys.stdout.flush()
-                        update_strings=[]
-                    break
-            # TODO: make sure commits occur frequently, change based on batch size and such
-            #       should know size of segment too, change to segment_size - 4
-            print(THEHOSTNAME, "Solve number list: %s" % len(solve_number_list))
-            # XXXX: divided by two because it is confusing not to have
-            #       these two numbers match spaces added for
-            #       readability
-            print(THEHOSTNAME, "Queued for update:    %s" % len(update_strings)/2)
-            sys.stdout.flush()
-            if len(update_strings) > MAXUPDATESTRINGS:
-                print("Updating...")
-                sys.stdout.flush()
-                CURSOR.execute(''.join(update_strings))
-                print("Committing...")
-                sys.stdout.flush()
-                CONNECTION.commit()
-                print("Done committing.")
-                sys.stdout.flush()
-                update_strings=[]
-            # TODO: a bare minimum sleep seems to be necessary to avoid locking up
-            #       implementing using threading would be far better
-            time.sleep(0.01)
-        if update_strings != []:
-            CURSOR.execute(''.join(update_strings))
-            CONNECTION.commit()
-            update_strings=[]
     CONNECTION.commit()
     CONNECTION.close()
+    METRICS['fh'].close()
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
         print("PROCESSES: "        + str(PROCESSES))
         print("MAXTASKSPERCHILD: " + str(MAXTASKSPERCHILD))
-        main(sys.argv)
+        print("CLAIM_WORK: "       + str(CLAIM_WORK))
+        print("NOTIFY_WORK: "      + str(NOTIFY_WORK))
+        print("PROFILE_WORKERS: "  + str(PROFILE_WORKERS))
+        try:
+            main(sys.argv)
+        finally:
+            if CLAIM_WORK:
+                db_release_host(sys.argv[3])
         POOL.close()
         POOL.join()
@@ -36,6 +36,118 @@ try:
     from db_defaults_local import *
 except ImportError:
     pass
+from db_notify import *
+from db_schedule import *
+
+# wait for db_solver.py to notify that it committed results rather
+# than checking every CHECKDELAY, db_solver.py must also be run with
+# --notify
+NOTIFY_WORK='--notify' in sys.argv
+# assign work by the seconds it is expected to take rather than by
+# count, from the worker time of problems that are already solved
+COST_MODEL='--cost-model' in sys.argv
+
+# when the predictions were last made, how many problems they covered
+# and the prediction for problems nothing is known about
+COST_STATE={'refreshed':None,'predicted':0,'default':1.0}
+
+def host_capacity(host):
+    return HOST_CAPACITY.get(host,TYPICAL_CORES)
+
+def cost_key(alias,columns):
+    """SQL for the key problems are grouped by to predict their cost."""
+    return "concat_ws('|'," + ','.join([alias + '.' + k for k in ('solver_object','method_properties','ode_properties')] + [alias + '."' + k + '"::text' for k in COST_KEYS if k in columns]) + ")"
+
+def cost_model_refresh(CONNECTION,CURSOR,batch_table):
+    """Predict the seconds each problem that is not done will take into
+the temporary table db_watcher_predicted.
+
+    The prediction is the mean worker time of the solved problems with
+    the same solver_object, method_properties, ode_properties and
+    COST_KEYS, or without the COST_KEYS if none of those are solved.
+
+    """
+    CURSOR.execute("SELECT DISTINCT table_name FROM " + batch_table + " WHERE done=FALSE;")
+    dbtables=[row[0] for row in CURSOR.fetchall()]
+    CURSOR.execute("DROP TABLE IF EXISTS db_watcher_predicted;")
+    CURSOR.execute("CREATE TEMPORARY TABLE db_watcher_predicted (solve_number bigint PRIMARY KEY, seconds double precision);")
+    for dbtable in dbtables:
+        CURSOR.execute("SELECT * FROM " + dbtable + " LIMIT 0;")
+        columns=[d[0] for d in CURSOR.description]
+        CURSOR.execute("INSERT INTO db_watcher_predicted SELECT u.solve_number,coalesce(k.seconds,s.seconds) FROM " + dbtable + " u"
+                       + " JOIN " + batch_table + " b ON b.solve_number=u.solve_number"
+                       + " LEFT JOIN (SELECT " + cost_key('d',columns) + " AS key,avg(d.\"worker time\") AS seconds FROM " + dbtable + " d WHERE d.\"worker time\" IS NOT NULL GROUP BY 1) k ON k.key=" + cost_key('u',columns)
+                       + " LEFT JOIN (SELECT solver_object,method_properties,ode_properties,avg(\"worker time\") AS seconds FROM " + dbtable + " WHERE \"worker time\" IS NOT NULL GROUP BY 1,2,3) s"
+                       + " ON s.solver_object=u.solver_object AND s.method_properties=u.method_properties AND s.ode_properties=u.ode_properties"
+                       + " WHERE b.done=FALSE AND b.table_name=%s;",(dbtable,))
+    # problems nothing is known about are assumed to be average
+    CURSOR.execute("SELECT avg(seconds),count(seconds),count(*) FROM db_watcher_predicted;")
+    average,predicted,total=CURSOR.fetchone()
+    if average is not None:
+        COST_STATE['default']=float(average)
+    CONNECTION.commit()
+    COST_STATE['refreshed']=TIME_TIME()
+    COST_STATE['predicted']=predicted
+    print("Predicted %s of %s problems, %.4f seconds on average" % (predicted,total,COST_STATE['default']))
+    sys.stdout.flush()
+
+def assign_by_cost(CONNECTION,CURSOR,batch_table):
+    """Assign each host in HOSTLIST with less than its share of predicted
+work the longest unassigned problems, up to CHUNK_SECONDS per core or
+less near the end so the last of the work is spread over every host,
+but not less than CHECKDELAY per core since that is how long a host
+waits for more.
+
+    Returns False once there is no unassigned work.
+
+    """
+    # until something is solved every problem is the made up default,
+    # so predict again every cycle until then
+    if COST_STATE['refreshed'] is None or COST_STATE['predicted'] == 0 or TIME_TIME()-COST_STATE['refreshed'] > COST_REFRESH:
+        cost_model_refresh(CONNECTION,CURSOR,batch_table)
+    predicted_seconds="coalesce(p.seconds," + repr(COST_STATE['default']) + ")"
+    CURSOR.execute("SELECT b.hostname,count(*),sum(" + predicted_seconds + ") FROM " + batch_table + " b LEFT JOIN db_watcher_predicted p ON p.solve_number=b.solve_number WHERE b.done=FALSE GROUP BY b.hostname;")
+    pending=dict((row[0],(row[1],row[2])) for row in CURSOR.fetchall())
+    if None not in pending:
+        return False
+    # problems that failed on a host are not counted
+    remaining_per_core=sum(pending[host][1] for host in HOSTLIST + [None] if host in pending)/sum(host_capacity(host) for host in HOSTLIST)
+    # a host waits up to CHECKDELAY for more, so it gets at least that
+    # much unless that is more than its share of what is left
+    budget_per_core=max(min(CHUNK_SECONDS,remaining_per_core/NOMINAL_PARITIONS),min(CHECKDELAY,remaining_per_core))
+    # the unassigned problems are ranked longest first once, each host
+    # then gets the next of them in rank
+    CURSOR.execute("DROP TABLE IF EXISTS db_watcher_ranked;")
+    CURSOR.execute("CREATE TEMPORARY TABLE db_watcher_ranked AS SELECT b.solve_number," + predicted_seconds + " AS seconds,sum(" + predicted_seconds + ") OVER w AS cumulative,row_number() OVER w AS n"
+                   + " FROM " + batch_table + " b LEFT JOIN db_watcher_predicted p ON p.solve_number=b.solve_number"
+                   + " WHERE b.hostname IS NULL AND b.done=FALSE"
+                   + " WINDOW w AS (ORDER BY " + predicted_seconds + " DESC,b.solve_number);")
+    # the rank and predicted seconds assigned so far
+    assigned_n=0
+    assigned_seconds=0.0
+    for host in HOSTLIST:
+        count,seconds=pending.get(host,(0,0.0))
+        budget=host_capacity(host)*budget_per_core
+        # keep every core busy and at least half the budget queued
+        if count >= host_capacity(host) and seconds >= budget/2:
+            continue
+        # the first problem is always assigned even if it is longer
+        # than the budget
+        CURSOR.execute("WITH a AS (UPDATE " + batch_table + " b SET hostname=%s FROM db_watcher_ranked r"
+                       + " WHERE b.solve_number=r.solve_number AND b.hostname IS NULL AND b.done=FALSE"
+                       + " AND r.n > %s AND (r.cumulative-r.seconds < %s OR r.n <= %s) RETURNING r.n,r.cumulative)"
+                       + " SELECT count(*),max(n),max(cumulative) FROM a;",
+                       (host,assigned_n,assigned_seconds+budget-seconds,assigned_n+host_capacity(host)-count))
+        number_assigned,last_n,last_cumulative=CURSOR.fetchone()
+        if number_assigned > 0:
+            assigned_n=last_n
+            assigned_seconds=float(last_cumulative)
+        print("Assigned %s problems to %s, %.1f predicted seconds" % (number_assigned,host,budget-seconds))
+        if NOTIFY_WORK:
+            db_notify(CURSOR,assigned_channel(batch_table),host)
+    CONNECTION.commit()
+    return True
+
 
 # TODO: problem... assigns all work to one machine when doing small number of reference solutions
 # TODO: benchmark the random's
@@ -46,53 +158,61 @@ def main(argv):
     # open connection to database
     CONNECTION,CURSOR=open_database(None,None)
     batch_table = argv[3]
+    if NOTIFY_WORK:
+        db_listen(CONNECTION,CURSOR,done_channel(batch_table))
+    db_create_indexes(CONNECTION,CURSOR,batch_table)
+    if '--setup' in sys.argv:
+        # only prepare the batch table, for db_solver.py --claim
+        db_create_lease_column(CONNECTION,CURSOR,batch_table)
+        CONNECTION.close()
+        return 0
     if '--host-only' in sys.argv:
         HOSTLIST=[socket.gethostname()]
     # TODO: get host list
-    # TODO: get all hosts with unassigned work at once
     selected_count_string="SELECT count(*) FROM " + batch_table + ";"
     CURSOR.execute(selected_count_string)
     selected=CURSOR.fetchall()
     CONNECTION.commit()
     print("Number of problems: %s" % selected[0][0])
-    # TODO: I should just count in database rather than moving whole thing...
     while True:
-        # is amount of work to partition less than LIMIT*hosts, only reduce once
-        # only do if there is more than one host
-        # TODO: should I still do it if only one host
-        if len(HOSTLIST) > 1 and reductions < MAXREDUCTIONS:
-            selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE ORDER BY random();"
-            CURSOR.execute(selected_unassigned_string)
-            unassigned=CURSOR.fetchall()
-            if len(unassigned) < LIMITPERSEGMENT*len(HOSTLIST)*NOMINAL_PARITIONS:
-                # only reduce once, split up so each host gets assigned fourth times more on average
-                # allow assigning only 1 task for cases with small numbers of long running jobs
-                LIMITPERSEGMENT = max(TYPICAL_CORES,len(unassigned)/(len(HOSTLIST)*NOMINAL_PARITIONS))
-                print("Reduced limit per segment to: %s" % LIMITPERSEGMENT)
-                reductions += 1
-        for host in HOSTLIST:
-            selected_batch_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname='" + host + "' AND done=FALSE;"
-            CURSOR.execute(selected_batch_string)
-            selected=CURSOR.fetchall()
-            # if the host has undone work, do not finish
-            if len(selected) >= TYPICAL_CORES:
-                continue
-            else:
-                selected_unassigned_string="SELECT table_name,solve_number FROM " + batch_table + " WHERE hostname IS NULL AND done=FALSE;"
-                CURSOR.execute(selected_unassigned_string)
-                unassigned=CURSOR.fetchall()
-                if unassigned == []:
-                    # we are done
+        if COST_MODEL:
+            if not assign_by_cost(CONNECTION,CURSOR,batch_table):
+                # we are done
+                return 0
+        else:
+            # problems not done for each host, None is unassigned
+            counts=db_work_counts(CURSOR,batch_table)
+            unassigned=counts.get(None,0)
+            # is amount of work to partition less than LIMIT*hosts, only reduce once
+            # only do if there is more than one host
+            # TODO: should I still do it if only one host
+            if len(HOSTLIST) > 1 and reductions < MAXREDUCTIONS:
+                if unassigned < LIMITPERSEGMENT*len(HOSTLIST)*NOMINAL_PARITIONS:
+                    # only reduce once, split up so each host gets assigned fourth times more on average
+                    # allow assigning only 1 task for cases with small numbers of long running jobs
+                    LIMITPERSEGMENT = max(TYPICAL_CORES,unassigned/(len(HOSTLIST)*NOMINAL_PARITIONS))
+                    print("Reduced limit per segment to: %s" % LIMITPERSEGMENT)
+                    reductions += 1
+            for host in HOSTLIST:
+                # if the host has undone work, do not finish
+                if counts.get(host,0) >= TYPICAL_CORES:
+                    continue
+                elif unassigned == 0:
+                    # we are done, keep anything just assigned
+                    CONNECTION.commit()
                     return 0
                 else:
-                    # assign a random-sized chunk of work for hostname, make sure if there are only a small number of problems they still get distributed
+                    # assign a chunk of work for hostname, make sure if there are only a small number of problems they still get distributed
                     # TODO: this might cause issues with many problems being sent out at very end..., we'll see
-                    # TODO: make this always assign at least TYPICAL_CORES....
-                    #       number_to_assign is just used as a limit in sql statement, but not obvious from API whether it needs to be exact
-                    number_to_assign=max(TYPICAL_CORES,min(len(unassigned),LIMITPERSEGMENT))
-                    assign_work_chunk(CONNECTION,CURSOR,sys.argv[3],host,number_to_assign)
+                    number_to_assign=max(TYPICAL_CORES,min(unassigned,LIMITPERSEGMENT))
+                    unassigned-=db_assign_chunk(CURSOR,batch_table,host,number_to_assign)
+                    if NOTIFY_WORK:
+                        db_notify(CURSOR,assigned_channel(batch_table),host)
         CONNECTION.commit()
-        time.sleep(CHECKDELAY)
+        if NOTIFY_WORK:
+            db_wait(CONNECTION,HEARTBEAT)
+        else:
+            time.sleep(CHECKDELAY)
     CONNECTION.commit()
     CONNECTION.close()
 
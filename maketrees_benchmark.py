@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: iso-8859-15 -*-
+"""Benchmark tree generation, invariants, code emission and the
+generated scalar sums.  Does not need a database or SageMath.
+
+Usage: python maketrees_benchmark.py [output.json] [--compare previous.json]
+
+"""
+# Copyright (C) 2018-2026, Andrew Kroshko, all rights reserved.
+#
+# Author: Andrew Kroshko
+# Maintainer: Andrew Kroshko <boreal6502@gmail.com>
+# Created: Sun Oct 18, 2026
+# Version: 20261018
+# URL: https://github.com/akroshko/python-sample-code
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at
+# your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses/.
+
+import contextlib
+from copy import deepcopy
+import datetime
+import io
+import json
+import math as m
+import os
+from pprint import pprint
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# orders for generation, invariants and emission
+BENCHMARK_ORDER=11
+# order of the generated scalar sums that are evaluated, the classic
+# sums get very slow above this
+EVALUATION_ORDER=6
+EVALUATION_STAGES=[2,4,8]
+# tableaux per stage count, and the size of a stacked batch for NumPy
+EVALUATION_TABLEAUX=20
+EVALUATION_BATCH=64
+
+LIBRARY=os.path.join(os.path.dirname(os.path.abspath(__file__)),'maketrees_library.sage')
+
+def load_library():
+    """Load maketrees_library.sage into a namespace the same way the
+maketrees*.sage files do.  The library does not use anything from
+SageMath itself.
+
+    """
+    namespace = {'deepcopy':deepcopy,'m':m,'pprint':pprint,'__file__':LIBRARY}
+    with open(LIBRARY) as fh:
+        exec(compile(fh.read(),LIBRARY,'exec'),namespace)
+    return namespace
+
+def measure(function,*args):
+    """Run function twice, once for the time and once under tracemalloc
+for the peak memory, since tracemalloc slows everything down.
+
+    """
+    starttime = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter()-starttime
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result,elapsed,peak
+
+def row(order,count,elapsed,peak):
+    return {'order':order,
+            'trees':count,
+            'seconds':elapsed,
+            'peak_bytes':peak,
+            'trees_per_second':(count/elapsed if elapsed > 0 else None)}
+
+def benchmark_generation(lib,maxorder):
+    results = []
+    for order in range(1,maxorder+1):
+        def generate():
+            return sum(1 for i,levels in lib['iter_standard_trees'](order) if i == order)
+        count,elapsed,peak = measure(generate)
+        results.append(row(order,count,elapsed,peak))
+        print("generation      order %2d: %7d trees %9.4fs" % (order,count,elapsed))
+    return results
+
+def benchmark_tree_sort(lib,trees):
+    results = []
+    for order in trees:
+        tuple_trees = [t.to_tree() for t in trees[order]]
+        def sort_trees():
+            return [lib['tree_sort'](t) for t in tuple_trees]
+        sorted_trees,elapsed,peak = measure(sort_trees)
+        results.append(row(order,len(sorted_trees),elapsed,peak))
+        print("tree_sort       order %2d: %7d trees %9.4fs" % (order,len(sorted_trees),elapsed))
+    return results
+
+def benchmark_invariants(lib,trees):
+    results = []
+    for order in trees:
+        def invariants():
+            # start cold every time, the cache is what is being measured
+            lib['TREE_INVARIANTS_CACHE'].clear()
+            return [lib['level_sequence_invariants'](t.levels) for t in trees[order]]
+        values,elapsed,peak = measure(invariants)
+        results.append(row(order,len(values),elapsed,peak))
+        print("invariants      order %2d: %7d trees %9.4fs" % (order,len(values),elapsed))
+    return results
+
+def benchmark_emission(lib,trees):
+    results = {'classic':[],'numpy':[]}
+    for order in trees:
+        def classic():
+            return [lib['make_expression'](lib['make_expression_levels'](t)) for t in trees[order]]
+        def numpy_expressions():
+            return [lib['make_numpy_expression'](t) for t in trees[order]]
+        for name,function in (('classic',classic),('numpy',numpy_expressions)):
+            expressions,elapsed,peak = measure(function)
+            results[name].append(row(order,len(expressions),elapsed,peak))
+            print("emission %-7s order %2d: %7d trees %9.4fs" % (name,order,len(expressions),elapsed))
+    return results
+
+def generate_trees(lib,directory,order):
+    olddirectory = os.getcwd()
+    os.chdir(directory)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            lib['create_standard_trees'](order)
+    finally:
+        os.chdir(olddirectory)
+
+def random_tableau(s,rng):
+    # explicit, with the usual row sum condition
+    A = [[(rng.random() if j < i else 0.0) for j in range(s)] for i in range(s)]
+    b = [rng.random() for i in range(s)]
+    c = [sum(row) for row in A]
+    return A,b,c
+
+def benchmark_evaluation(directory,maxorder):
+    """Scalar sum evaluations per second of the generated functions for
+random numeric tableaux.
+
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    sys.path.insert(0,directory)
+    try:
+        from generated_trees import rk_trees
+        # scalar sums per evaluation of every order
+        count = sum(len(rk_trees.gammas[order]) for order in range(1,maxorder+1))
+        rng = random.Random(20261018)
+        results = []
+        for s in EVALUATION_STAGES:
+            tableaux = [random_tableau(s,rng) for i in range(EVALUATION_TABLEAUX)]
+            functions = {'dag':lambda A,b,c: rk_trees.rk_dag_scalar_sums(A,b,c,maxorder=maxorder)}
+            if np is not None:
+                # the classic sums need A.T
+                tableaux = [(np.array(A),np.array(b),np.array(c)) for A,b,c in tableaux]
+                functions['classic'] = lambda A,b,c: rk_trees.rk_classic_scalar_sums(A,b,c,maxorder=maxorder)
+                functions['numpy'] = lambda A,b,c: rk_trees.rk_numpy_scalar_sums(A,b,c,maxorder=maxorder)
+            for name in sorted(functions):
+                # load and compile everything before timing
+                functions[name](*tableaux[0])
+                starttime = time.perf_counter()
+                for A,b,c in tableaux:
+                    functions[name](A,b,c)
+                elapsed = time.perf_counter()-starttime
+                results.append({'method':name,'stages':s,'tableaux':len(tableaux),'seconds':elapsed,
+                                'evaluations_per_second':count*len(tableaux)/elapsed})
+                print("evaluation %-7s s=%d: %12.1f sums/s" % (name,s,count*len(tableaux)/elapsed))
+            if np is not None:
+                A = np.array([A for A,b,c in tableaux[:1]]*EVALUATION_BATCH)
+                A = A*(1.0+0.01*np.arange(EVALUATION_BATCH).reshape((-1,1,1)))
+                b = np.tile(tableaux[0][1],(EVALUATION_BATCH,1))
+                c = A.sum(axis=-1)
+                rk_trees.rk_numpy_scalar_sums(A,b,c,maxorder=maxorder)
+                starttime = time.perf_counter()
+                rk_trees.rk_numpy_scalar_sums(A,b,c,maxorder=maxorder)
+                elapsed = time.perf_counter()-starttime
+                results.append({'method':'numpy batch','stages':s,'tableaux':EVALUATION_BATCH,'seconds':elapsed,
+                                'evaluations_per_second':count*EVALUATION_BATCH/elapsed})
+                print("evaluation %-7s s=%d: %12.1f sums/s" % ('batch',s,count*EVALUATION_BATCH/elapsed))
+    finally:
+        sys.path.remove(directory)
+        for name in list(sys.modules):
+            if name == 'generated_trees' or name.startswith('generated_trees.'):
+                del sys.modules[name]
+    return results
+
+def compare(results,previous):
+    """Print the ratio of the times in results to the ones in previous."""
+    for section in ('generation','tree_sort','invariants'):
+        old = dict((r['order'],r['seconds']) for r in previous.get(section,[]))
+        for r in results[section]:
+            if old.get(r['order']):
+                print("%-12s order %2d: %6.2fx" % (section,r['order'],r['seconds']/old[r['order']]))
+    old = dict(((r['method'],r['stages']),r['evaluations_per_second']) for r in previous.get('evaluation',[]))
+    for r in results['evaluation']:
+        if old.get((r['method'],r['stages'])):
+            print("%-12s s=%d: %6.2fx sums/s" % (r['method'],r['stages'],r['evaluations_per_second']/old[(r['method'],r['stages'])]))
+
+def main(argv):
+    arguments = argv[1:]
+    previous = None
+    if '--compare' in arguments:
+        previous = arguments[arguments.index('--compare')+1]
+        del arguments[arguments.index('--compare'):arguments.index('--compare')+2]
+    if arguments:
+        output = arguments[0]
+    else:
+        output = 'maketrees_benchmark_' + datetime.datetime.now().strftime('%Y%m%dT%H%M%S') + '.json'
+    lib = load_library()
+    results = {'python':sys.version,
+               'timestamp':datetime.datetime.now().isoformat(),
+               'benchmark_order':BENCHMARK_ORDER,
+               'evaluation_order':EVALUATION_ORDER}
+    results['generation'] = benchmark_generation(lib,BENCHMARK_ORDER)
+    trees = lib['create_rooted_trees'](BENCHMARK_ORDER)
+    results['tree_sort'] = benchmark_tree_sort(lib,trees)
+    results['invariants'] = benchmark_invariants(lib,trees)
+    results['emission'] = benchmark_emission(lib,trees)
+    directory = tempfile.mkdtemp(prefix='maketrees_benchmark_')
+    try:
+        starttime = time.perf_counter()
+        generate_trees(lib,directory,EVALUATION_ORDER)
+        results['create_standard_trees_seconds'] = time.perf_counter()-starttime
+        results['evaluation'] = benchmark_evaluation(directory,EVALUATION_ORDER)
+    finally:
+        shutil.rmtree(directory)
+    with open(output,'w') as fh:
+        json.dump(results,fh,indent=1)
+    print("Written to: %s" % output)
+    if previous:
+        with open(previous) as fh:
+            compare(results,json.load(fh))
+
+if __name__ == '__main__':
+    main(sys.argv)